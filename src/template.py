@@ -11,11 +11,21 @@ http://aosabook.org/en/500L/a-template-engine.html
 # Coincidentally named the same as http://code.activestate.com/recipes/496702/
 
 import re
-from functools import cached_property
+from collections import ChainMap
+from functools import cached_property, lru_cache
+from hashlib import blake2b
 from os.path import isfile
+from sys import intern
 from typing import Generator
 
 
+_TOKEN_RE = re.compile(r"{{.*?}}|{%.*?%}|{#.*?#}", re.DOTALL)
+
+_CODE_CACHE = {}  # digest of generated source -> compiled code object
+
+_MISSING = object()  # sentinel for exception-free lookups
+
+
 class TemplateSyntaxError(ValueError):
     """Raised when a template has a syntax error."""
 
@@ -39,9 +49,18 @@ class CodeBuilder:
     def __init__(self, indent=0):
         self.code = []
         self.indent_level = indent
+        self._block_marks = []
 
     def __str__(self):
-        return "".join(map(str, self.code))
+        return "".join(self._flatten())
+
+    def _flatten(self):
+        """Yield the string fragments of this builder and its sub-sections."""
+        for fragment in self.code:
+            if isinstance(fragment, CodeBuilder):
+                yield from fragment._flatten()
+            else:
+                yield fragment
 
     def add_line(self, line):
         """Add a line of source to the code.
@@ -60,9 +79,13 @@ class CodeBuilder:
     def indent(self):
         """Increase the current indent for following lines."""
         self.indent_level += 1
+        self._block_marks.append(len(self.code))
 
     def dedent(self):
         """Decrease the current indent for following lines."""
+        # If the block body folded away to nothing, keep the source valid.
+        if self._block_marks.pop() == len(self.code):
+            self.add_line("pass")
         self.indent_level -= 1
 
     def get_globals(self):
@@ -71,9 +94,16 @@ class CodeBuilder:
         assert self.indent_level == 0
         # Get the Python source as a single string.
         python_source = str(self)
-        # Execute the source, defining globals, and return them.
+        # Compile once per distinct source, so identical templates share the
+        # same code object across constructions.
+        key = blake2b(python_source.encode(), digest_size=16).digest()
+        code_object = _CODE_CACHE.get(key)
+        if code_object is None:
+            code_object = _CODE_CACHE[key] = compile(
+                python_source, f"<template:{key.hex()}>", "exec")
+        # Execute the code, defining globals, and return them.
         global_namespace = {}
-        exec(python_source, global_namespace)
+        exec(code_object, global_namespace)
         return global_namespace
 
 
@@ -89,12 +119,34 @@ class Template:
         """
         self.context = {}
         for context in contexts:
-            self.context.update(context)
+            for key, value in context.items():
+                self.context[intern(key)] = value
 
         self.text = text
         self.strict = strict
+        # Specialize on the flag once, so renders don't branch on it.
+        self.get_renderer = self._get_renderer_strict if strict else self._get_renderer_lax
+        # A text without any markers needs no parsing or code generation.
+        if "{{" not in text and "{%" not in text and "{#" not in text:
+            self._literal = text
+        else:
+            self._literal = None
         self.vars_need = set()  # variables must provide
         self.vars_defs = set()  # variables been defined inside template (now loop only)
+        self.vars_folded = set()  # if conditions folded to constants at codegen time
+        self._fold = True
+
+    @classmethod
+    @lru_cache(maxsize=512)
+    def compile_cached(cls, text, strict=True):
+        """Build the Template for `text` once and reuse it on later calls.
+
+        Contexts aren't hashable, so callers needing construction-time
+        globals should construct directly; the cache keys on `text` and
+        `strict` only.
+
+        """
+        return cls(text, strict=strict)
 
     @classmethod
     def load_template(cls, path, context=None, *args, **kwargs):
@@ -110,122 +162,202 @@ class Template:
     def code(self):
         self.vars_need.clear()
         self.vars_defs.clear()
+        self.vars_folded.clear()
 
         # We construct a function in source form, then compile it and hold onto
         # it, and execute it to render the template.
         code = CodeBuilder()
 
-        code.add_line("def render_function(context, do_dots, load_template):")
+        code.add_line("def render_function(context, do_dot, load_template):")
         code.indent()
         vars_code = code.add_section()
         code.add_line("result = []")
-        code.add_line("append_result = result.append")
-        code.add_line("extend_result = result.extend")
-        code.add_line("to_str = str")
+        # Filled in at the end with only the helper bindings the body uses.
+        helpers_code = code.add_section()
+        helpers_used = set()
 
         buffered = []
+        pending_literals = []
+
+        def flush_literals():
+            """Coalesce adjacent literal chunks into one buffered string."""
+            if pending_literals:
+                buffered.append(repr("".join(pending_literals)))
+                pending_literals.clear()
 
         def flush_output():
             """Force `buffered` to the code builder."""
+            flush_literals()
             if len(buffered) == 1:
+                helpers_used.add("append_result")
                 code.add_line(f"append_result({buffered[0]})")
             elif len(buffered) > 1:
+                helpers_used.add("extend_result")
                 code.add_line(f"extend_result(({', '.join(buffered)}))")
             buffered.clear()
 
         ops_stack = []
-
-        # Split the text to form a list of tokens.
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", self.text)
+        folded = {}  # ops_stack depths whose `if` was folded at codegen time
 
         squash = False
 
-        for token in tokens:
-            if token.startswith("{"):
-                start, end = 2, -2
-                squash = (token[-3] == "-")
-                if squash:
-                    end = -3
-
-                if token.startswith("{#"):
-                    # Comment: ignore it and move on.
-                    continue
-                elif token.startswith("{{"):
-                    # An expression to evaluate.
-                    expr = self._expr_code(token[start:end].strip())
-                    buffered.append(f"to_str({expr})")
-                else:
-                    assert token.startswith("{%")
-                    # Action tag: split into words and parse further.
-                    flush_output()
-
-                    words = token[start:end].strip().split()
-                    if words[0] == "if":
-                        # An if statement: evaluate the expression to determine if.
-                        if len(words) != 2:
-                            raise TemplateSyntaxError("Don't understand if", token)
-                        ops_stack.append("if")
-                        code.add_line(f"if {self._expr_code(words[1])}:")
-                        code.indent()
-                    elif words[0] == "for":
-                        # A loop: iterate over expression result.
-                        if len(words) != 4 or words[2] != "in":
-                            raise TemplateSyntaxError("Don't understand for", token)
-                        ops_stack.append("for")
-                        self._declare(words[1])
-                        code.add_line(f"for c_{words[1]} in {self._expr_code(words[3])}:")
-                        code.indent()
-                    elif words[0] == "import":
-                        # A component.
-                        if len(words) != 4 or words[2] != "as":
-                            raise TemplateSyntaxError("Don't understand import", token)
-                        path, name = words[1], words[3]
-                        self._declare(name)
-                        code.add_line(f"c_{name} = load_template({path})")
-
-                    elif words[0] == "slot":
-                        code.add_line("yield ''.join(result)")
-                        code.add_line("result.clear()")
-
-                    elif words[0].startswith("end"):
-                        # End something. Pop the ops stack.
-                        if len(words) != 1:
-                            raise TemplateSyntaxError("Don't understand end", token)
-                        end_what = words[0][3:]
-                        if not ops_stack:
-                            raise TemplateSyntaxError("Too many ends", token)
-                        start_what = ops_stack.pop()
-                        if start_what != end_what:
-                            raise TemplateSyntaxError("Mismatched end tag", end_what)
-
-                        if end_what == "for" or end_what == "if":
-                            code.dedent()
+        # Scan the text in a single pass, emitting the literal before each
+        # token and then the token itself. The matches are materialized so
+        # loop specialization below can peek at the next tokens.
+        matches = list(_TOKEN_RE.finditer(self.text))
+        pos = 0
+        index = 0
+        while index < len(matches):
+            match = matches[index]
+            index += 1
+            token = self.text[pos:match.start()]
+            if squash:
+                token = token.lstrip()
+            if token:
+                pending_literals.append(token)
+            pos = match.end()
+
+            token = match.group()
+            start, end = 2, -2
+            squash = (token[-3] == "-")
+            if squash:
+                end = -3
+
+            if token.startswith("{#"):
+                # Comment: ignore it and move on.
+                continue
+            elif token.startswith("{{"):
+                # An expression to evaluate.
+                expr = self._expr_code(token[start:end].strip())
+                helpers_used.add("to_str")
+                flush_literals()
+                buffered.append(f"to_str({expr})")
+            else:
+                assert token.startswith("{%")
+                # Action tag: split into words and parse further.
+                flush_output()
+
+                words = token[start:end].strip().split()
+                if words[0] == "if":
+                    # An if statement: evaluate the expression to determine if.
+                    if len(words) != 2:
+                        raise TemplateSyntaxError("Don't understand if", token)
+                    cond = words[1]
+                    if (self._fold and "|" not in cond and "." not in cond
+                            and cond not in self.vars_defs and cond in self.context):
+                        # The condition is a construction-time constant: fold
+                        # the branch at codegen time instead of checking it on
+                        # every render. Renders that shadow the name fall back
+                        # to the unfolded twin in get_renderer.
+                        self.vars_folded.add(intern(cond))
+                        if self.context[cond]:
+                            # Emit the body inline; the endif closes nothing.
+                            folded[len(ops_stack)] = True
+                            ops_stack.append("if")
                         else:
-                            buffered.append(f"next(c_{end_what}_renderer)")
+                            # Dead branch: validate its tags but emit nothing.
+                            index = self._validate_dead_branch(matches, index)
+                            squash = (matches[index - 1].group()[-3] == "-")
+                            pos = matches[index - 1].end()
+                        continue
+                    ops_stack.append("if")
+                    code.add_line(f"if {self._expr_code(cond)}:")
+                    code.indent()
+                elif words[0] == "for":
+                    # A loop: iterate over expression result.
+                    if len(words) != 4 or words[2] != "in":
+                        raise TemplateSyntaxError("Don't understand for", token)
+                    self._declare(words[1])
+                    iter_code = self._expr_code(words[3])
+
+                    # A loop whose whole body is a single expression compiles
+                    # to one C-level map() over the iterable instead of a
+                    # Python-level loop of appends.
+                    if (index + 1 < len(matches)
+                            and matches[index].start() == match.end()
+                            and matches[index + 1].start() == matches[index].end()):
+                        body, closer = matches[index].group(), matches[index + 1].group()
+                        closer_end = -3 if closer[-3] == "-" else -2
+                        if (body.startswith("{{") and body[-3] != "-"
+                                and closer.startswith("{%")
+                                and closer[2:closer_end].strip() == "endfor"
+                                # This path never binds the loop variable, so
+                                # the rest of the template must not use it.
+                                and not re.search(rf"\b{words[1]}\b",
+                                                  self.text[matches[index + 1].end():])):
+                            expr = self._expr_code(body[2:-2].strip())
+                            helpers_used.update(("extend_result", "to_str"))
+                            if expr == f"c_{words[1]}":
+                                code.add_line(f"extend_result(map(to_str, {iter_code}))")
+                            else:
+                                code.add_line(
+                                    f"extend_result(map(lambda c_{words[1]}: to_str({expr}), {iter_code}))")
+                            squash = (closer_end == -3)
+                            pos = matches[index + 1].end()
+                            index += 2
+                            continue
+
+                    ops_stack.append("for")
+                    code.add_line(f"for c_{words[1]} in {iter_code}:")
+                    code.indent()
+                elif words[0] == "import":
+                    # A component.
+                    if len(words) != 4 or words[2] != "as":
+                        raise TemplateSyntaxError("Don't understand import", token)
+                    path, name = words[1], words[3]
+                    self._declare(name)
+                    code.add_line(f"c_{name} = load_template({path})")
+
+                elif words[0] == "slot":
+                    code.add_line("yield ''.join(result)")
+                    code.add_line("result.clear()")
+
+                elif words[0].startswith("end"):
+                    # End something. Pop the ops stack.
+                    if len(words) != 1:
+                        raise TemplateSyntaxError("Don't understand end", token)
+                    end_what = words[0][3:]
+                    if not ops_stack:
+                        raise TemplateSyntaxError("Too many ends", token)
+                    start_what = ops_stack.pop()
+                    if start_what != end_what:
+                        raise TemplateSyntaxError("Mismatched end tag", end_what)
+
+                    if end_what == "for" or end_what == "if":
+                        if not folded.pop(len(ops_stack), False):
+                            code.dedent()
+                    else:
+                        buffered.append(f"next(c_{end_what}_renderer)")
 
-                    elif words[0] in self.vars_defs:
-                        # Use a component.
-                        name = words[0]
-                        if "~" in words:
-                            buffered.append(f"c_{name}.render()")
-                        else:
-                            ops_stack.append(name)
-                            code.add_line(f"c_{name}_renderer = c_{name}.get_renderer()")
-                            buffered.append(f"next(c_{name}_renderer)")
+                elif words[0] in self.vars_defs:
+                    # Use a component.
+                    name = words[0]
+                    if "~" in words:
+                        buffered.append(f"c_{name}.render()")
                     else:
-                        raise TemplateSyntaxError("Don't understand tag", words[0])
-            else:
-                # Literal content. If it isn't empty, output it.
-                if squash:
-                    token = token.lstrip()
-                if token:
-                    buffered.append(repr(token))
+                        ops_stack.append(name)
+                        code.add_line(f"c_{name}_renderer = c_{name}.get_renderer()")
+                        buffered.append(f"next(c_{name}_renderer)")
+                else:
+                    raise TemplateSyntaxError("Don't understand tag", words[0])
+
+        token = self.text[pos:]
+        if squash:
+            token = token.lstrip()
+        if token:
+            pending_literals.append(token)
 
         if ops_stack:
             raise TemplateSyntaxError("Unmatched action tag", ops_stack[-1])
 
         flush_output()
 
+        for helper, binding in (("append_result", "append_result = result.append"),
+                                ("extend_result", "extend_result = result.extend"),
+                                ("to_str", "to_str = str")):
+            if helper in helpers_used:
+                helpers_code.add_line(binding)
+
         self.extract_context_to_code(vars_code)
 
         code.add_line("yield ''.join(result)")
@@ -242,6 +374,73 @@ class Template:
             for var in self.vars_need:
                 code.add_line(f"c_{var} = context.get({var!r})")
 
+    def _validate_dead_branch(self, matches, index):
+        """Validate the tokens of a folded-out branch without emitting code.
+
+        The branch is never rendered, but its syntax must stay as valid as
+        live code, so validity doesn't depend on a constant's value. Returns
+        the index just past the matching endif.
+
+        """
+        dead_stack = []
+        while index < len(matches):
+            token = matches[index].group()
+            index += 1
+            if token.startswith("{#"):
+                continue
+            end = -3 if token[-3] == "-" else -2
+            if token.startswith("{{"):
+                self._validate_expr(token[2:end].strip())
+                continue
+            words = token[2:end].strip().split()
+            if words[0] == "if":
+                if len(words) != 2:
+                    raise TemplateSyntaxError("Don't understand if", token)
+                self._validate_expr(words[1])
+                dead_stack.append("if")
+            elif words[0] == "for":
+                if len(words) != 4 or words[2] != "in":
+                    raise TemplateSyntaxError("Don't understand for", token)
+                self.check_naming(words[1])
+                self._validate_expr(words[3])
+                dead_stack.append("for")
+            elif words[0] == "import":
+                if len(words) != 4 or words[2] != "as":
+                    raise TemplateSyntaxError("Don't understand import", token)
+                self.check_naming(words[3])
+            elif words[0] == "slot":
+                pass
+            elif words[0].startswith("end"):
+                if len(words) != 1:
+                    raise TemplateSyntaxError("Don't understand end", token)
+                end_what = words[0][3:]
+                if not dead_stack:
+                    if end_what == "if":
+                        # The endif that closes the folded branch.
+                        return index
+                    raise TemplateSyntaxError("Mismatched end tag", end_what)
+                if dead_stack.pop() != end_what:
+                    raise TemplateSyntaxError("Mismatched end tag", end_what)
+            elif words[0] in self.vars_defs:
+                if "~" not in words:
+                    dead_stack.append(words[0])
+            else:
+                raise TemplateSyntaxError("Don't understand tag", words[0])
+        raise TemplateSyntaxError("Unmatched action tag",
+                                  dead_stack[-1] if dead_stack else "if")
+
+    def _validate_expr(self, expr):
+        """Check the names in `expr` without recording variable usage."""
+        if "|" in expr:
+            pipes = expr.split("|")
+            self._validate_expr(pipes[0])
+            for func in pipes[1:]:
+                self.check_naming(func)
+        elif "." in expr:
+            self._validate_expr(expr.split(".")[0])
+        else:
+            self.check_naming(expr)
+
     def _expr_code(self, expr):
         """Generate a Python expression for `expr`."""
         if "|" in expr:
@@ -253,8 +452,10 @@ class Template:
         elif "." in expr:
             dots = expr.split(".")
             code = self._expr_code(dots[0])
-            args = ", ".join(repr(d) for d in dots[1:])
-            code = f"do_dots({code}, {args})"
+            for dot in dots[1:]:
+                # Unroll the chain so each render resolves the steps directly,
+                # without a runtime loop over the dot names.
+                code = f"do_dot({code}, {dot!r})"
         else:
             self._need(expr)
             code = f"c_{expr}"
@@ -269,49 +470,82 @@ class Template:
     def _declare(self, name):
         """Track that `name` is defined as a variable."""
         self.check_naming(name)
-        self.vars_defs.add(name)
+        self.vars_defs.add(intern(name))
 
     def _need(self, name):
         """Track that `name` is used as a variable."""
         self.check_naming(name)
         if name not in self.vars_defs:  # if it is already declared inside the template
-            self.vars_need.add(name)
+            self.vars_need.add(intern(name))
 
     @cached_property
     def render_function(self):
         return self.code.get_globals()["render_function"]
 
-    def get_renderer(self, context: dict = None) -> Generator:
-        # Make the complete context we'll use.
-        render_context = dict(self.context)
-        if context:
-            render_context.update(context)
+    @cached_property
+    def _unfolded(self):
+        """A twin compiled without constant folding.
+
+        Used when a render-time context shadows a folded condition, so the
+        branch check happens at run-time as if it had never been folded.
+
+        """
+        twin = Template(self.text, self.context, strict=self.strict)
+        twin._fold = False
+        return twin
+
+    def _get_renderer_lax(self, context: dict = None) -> Generator:
+        # Make the complete context we'll use: a view, not a copy.
+        render_context = ChainMap(context, self.context) if context else self.context
+
+        render_function = self.render_function
+        if context and not self.vars_folded.isdisjoint(context):
+            return self._unfolded.get_renderer(context)
+        return render_function(render_context, self._do_dot, self.load_template)
 
-        if not self.strict:
-            return self.render_function(render_context, self._do_dots, self.load_template)
+    def _get_renderer_strict(self, context: dict = None) -> Generator:
+        # Make the complete context we'll use: a view, not a copy.
+        render_context = ChainMap(context, self.context) if context else self.context
 
         # static namespace checking
         render_function = self.render_function
+        if context and not self.vars_folded.isdisjoint(context):
+            return self._unfolded.get_renderer(context)
         missing_vars = tuple(v for v in self.vars_need if v not in render_context.keys())
         if missing_vars:
             raise TemplateContextError(f"Missing context: {', '.join(missing_vars)}")
         # noinspection PyCallingNonCallable
-        return render_function(render_context, self._do_dots, self.load_template)
+        return render_function(render_context, self._do_dot, self.load_template)
 
-    def render(self, context: dict = None):
-        return next(self.get_renderer(context))
+    @cached_property
+    def render(self):
+        """The rendering callable, built once without method indirection."""
+        literal = self._literal
+        if literal is not None:
+            return lambda context=None: literal
+
+        get_renderer = self.get_renderer
+
+        def render(context: dict = None):
+            return next(get_renderer(context))
+
+        return render
 
     @staticmethod
-    def _do_dots(value, *dots):
-        """Evaluate dotted expressions at run-time."""
-        for dot in dots:
-            try:
-                value = getattr(value, dot)
-            except AttributeError:
+    def _do_dot(value, dot, _callable=callable):
+        """Evaluate one step of a dotted expression at run-time."""
+        result = getattr(value, dot, _MISSING)
+        if result is _MISSING:
+            if type(value) is dict:
+                # The common item-access case: no exception machinery at all.
+                result = value.get(dot, _MISSING)
+                if result is _MISSING:
+                    raise TemplateValueError(f"Couldn't evaluate {value!r}.{dot}")
+            else:
                 try:
-                    value = value[dot]
+                    result = value[dot]
                 except (TypeError, KeyError):
                     raise TemplateValueError(f"Couldn't evaluate {value!r}.{dot}")
-            if callable(value):
-                value = value()
-        return value
+        if _callable(result):
+            result = result()
+        return result
@@ -6,12 +6,19 @@
 
 import re
 import unittest
+from functools import lru_cache
 
 from src.template import Template, TemplateSyntaxError, TemplateValueError
 
 
 # pylint: disable=unused-variable
 
+@lru_cache(maxsize=None)
+def _syn_err_pattern(msg, thing):
+    """Compile the expected TemplateSyntaxError message exactly once."""
+    return re.compile("^" + re.escape(f"{msg}: {thing!r}") + "$")
+
+
 class AnyOldObject:
     """Simple testing object.
 
@@ -34,7 +41,7 @@ class TempliteTest(unittest.TestCase):
         an exception and never get to the result comparison.
 
         """
-        actual = Template(text).render(ctx or {})
+        actual = Template.compile_cached(text).render(ctx or {})
         # If result is None, then an exception should have prevented us getting
         # to here.
         assert result is not None
@@ -46,8 +53,7 @@ class TempliteTest(unittest.TestCase):
         A context manager, and the message should be `msg`.
 
         """
-        pat = "^" + re.escape(f"{msg}: {thing!r}") + "$"
-        return self.assertRaisesRegex(TemplateSyntaxError, pat)
+        return self.assertRaisesRegex(TemplateSyntaxError, _syn_err_pattern(msg, thing))
 
     def test_passthrough(self):
         # Strings without variables are passed through unchanged.
@@ -216,6 +222,52 @@ class TempliteTest(unittest.TestCase):
             "@XS!"
         )
 
+    def test_constant_if(self):
+        # Conditions bound at construction time are folded during codegen.
+        self.assertEqual(
+            Template("Hi, {% if ned %}NED{% endif %}!", {'ned': 1}).render(),
+            "Hi, NED!"
+        )
+        self.assertEqual(
+            Template("Hi, {% if ned %}NED{% endif %}!", {'ned': 0}).render(),
+            "Hi, !"
+        )
+        # A folded-out branch is dead code, even with nested tags: its
+        # variables are never needed.
+        self.assertEqual(
+            Template(
+                "@{% if ned %}{% if ben %}{{missing}}{% endif %}X{% endif %}!",
+                {'ned': 0}
+            ).render(),
+            "@!"
+        )
+        # Dead branches are still validated like live code.
+        with self.assertSynErr("Don't understand tag", "bogus"):
+            Template("{% if ned %}{% bogus %}{% endif %}", {'ned': 0}).render()
+        with self.assertSynErr("Mismatched end tag", "if"):
+            Template("{% if ned %}{% for x in y %}{% endif %}", {'ned': 0}).render()
+        with self.assertSynErr("Not a valid name", "var%&!@"):
+            Template("{% if ned %}{{ var%&!@ }}{% endif %}", {'ned': 0}).render()
+        # A render-time context overriding the constant wins, as everywhere.
+        self.assertEqual(
+            Template(
+                "val={{ned}} if={% if ned %}YES{% endif %}", {'ned': False}
+            ).render({'ned': True}),
+            "val=True if=YES"
+        )
+        self.assertEqual(
+            Template("{% if ned %}YES{% endif %}!", {'ned': True}).render({'ned': 0}),
+            "!"
+        )
+        # A branch folded out as the sole body of a loop still compiles.
+        self.assertEqual(
+            Template(
+                "{% for n in nums %}{% if ned %}X{% endif %}{% endfor %}done",
+                {'ned': 0}
+            ).render({'nums': [1, 2]}),
+            "done"
+        )
+
     def test_loop_if(self):
         self.try_render(
             "@{% for n in nums %}{% if n %}Z{% endif %}{{n}}{% endfor %}!",
@@ -329,6 +381,14 @@ class TempliteTest(unittest.TestCase):
             "@9012!"
         )
 
+    def test_loop_var_after_loop(self):
+        # The loop variable stays bound to its last value after the loop.
+        self.try_render(
+            "{% for n in nums %}{{n}}{% endfor %}-{{n}}",
+            {'nums': [1, 2, 3]},
+            "123-3"
+        )
+
     def test_nested_loop_redeclare(self):
         self.try_render(
             "@"